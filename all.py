@@ -3,25 +3,59 @@
 pd_mapping_all_teams.py
 
 Scans AWS CloudWatch alarms -> SNS -> PagerDuty integration keys.
-Loads ALL PagerDuty services AND ALL teams.
-If token lacks permission for a team, marks team as UNKNOWN.
+Loads ALL PagerDuty services with their embedded teams (include[]=teams).
+Team names come from the embedded team's summary/name; a service with no
+team, or whose embedded team has neither, is marked UNKNOWN.
 
-Generates: cloudwatch_pd_mapping.xlsx
+Generates: cloudwatch_pd_mapping.xlsx (or cloudwatch_pd_mapping.csv with OUTPUT_FORMAT=csv)
 """
 
 import os
 import re
 import time
 import sys
+import json
+import csv
+import itertools
+import hashlib
+import tempfile
+from contextlib import contextmanager
+from pathlib import Path
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import boto3
 import requests
-import pandas as pd
+import xlsxwriter
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from botocore.config import Config
 from botocore.exceptions import ClientError
 
 OUTPUT_XLSX = "cloudwatch_pd_mapping.xlsx"
+OUTPUT_CSV = "cloudwatch_pd_mapping.csv"
+OUTPUT_FORMAT = os.environ.get("OUTPUT_FORMAT", "xlsx").lower()  # xlsx | csv
+COLUMNS = (
+    "Region",
+    "AlarmName",
+    "AlarmActionStatus",
+    "SNSTopicArn",
+    "SNSTopicName",
+    "IntegrationKey",
+    "PagerDutyServiceName",
+    "PagerDutyServiceID",
+    "PagerDutyTeamName",
+    "PagerDutyTeamID"
+)
 PD_API_BASE = "https://api.pagerduty.com"
+_PD_KEY_RE = re.compile(r"/integration/([^/]+)/?")
+PD_INTEGRATION_PREFIX = "https://events.pagerduty.com/integration/"
 PD_TOKEN = os.environ.get("PD_TOKEN")
+PD_CACHE_TTL = int(os.environ.get("PD_CACHE_TTL", "3600"))  # seconds, 0 disables
+REGIONS_CACHE_TTL = 86400
+
+if OUTPUT_FORMAT not in ("xlsx", "csv"):
+    print(f"ERROR: OUTPUT_FORMAT must be xlsx or csv, got {OUTPUT_FORMAT!r}")
+    sys.exit(1)
 
 if not PD_TOKEN:
     print("ERROR: PD_TOKEN environment variable not set. Run:")
@@ -29,131 +63,231 @@ if not PD_TOKEN:
     sys.exit(1)
 
 boto_config = Config(retries={"max_attempts": 6, "mode": "standard"})
+MAX_REGION_WORKERS = 16
+PD_PAGE_LIMIT = 100
+PD_MAX_WORKERS = 5  # keeps us well under PagerDuty's 2000 req/min limit
+MAX_SNS_WORKERS = 8
 session = requests.Session()
 session.headers.update({
     "Accept": "application/vnd.pagerduty+json;version=2",
     "Authorization": f"Token token={PD_TOKEN}"
 })
+# Size the pool for the concurrent page fetches. 429 is deliberately not
+# retried here: pd_get's token bucket and the Retry-After handling in the
+# fetch functions own all PagerDuty rate limiting.
+session.mount("https://", HTTPAdapter(
+    pool_connections=20,
+    pool_maxsize=50,
+    max_retries=Retry(
+        total=5,
+        backoff_factor=0.3,
+        status_forcelist=[500, 502, 503, 504],
+        allowed_methods=["GET"],
+        raise_on_status=False
+    )
+))
 
 #########################################
 # PagerDuty Fetch Functions
 #########################################
 
-def fetch_all_pd_teams():
-    print("Fetching ALL PagerDuty teams...")
-    teams = {}
-    limit = 100
-    offset = 0
+# Token bucket shared by every thread that talks to PagerDuty, so parallel
+# page fetches stay inside the account-wide 2000 requests/minute budget.
+PD_RATE = 2000 / 60  # tokens per second
+PD_BURST = 50
+_pd_tokens = PD_BURST
+_pd_last = time.monotonic()
+_pd_bucket_lock = threading.Lock()
+
+def pd_get(url, **kwargs):
+    global _pd_tokens, _pd_last
+    with _pd_bucket_lock:
+        now = time.monotonic()
+        _pd_tokens = min(PD_BURST, _pd_tokens + (now - _pd_last) * PD_RATE)
+        _pd_last = now
+        if _pd_tokens < 1:
+            time.sleep((1 - _pd_tokens) / PD_RATE)
+            _pd_last = time.monotonic()
+            _pd_tokens = 1
+        _pd_tokens -= 1
+    return session.get(url, **kwargs)
+
+def fetch_pd_services_page(offset, total=False):
+    params = {
+        "limit": PD_PAGE_LIMIT,
+        "offset": offset,
+        "include[]": ["integrations", "teams"]
+    }
+    if total:
+        params["total"] = "true"
 
     while True:
-        params = {"limit": limit, "offset": offset}
-        resp = session.get(f"{PD_API_BASE}/teams", params=params)
+        resp = pd_get(f"{PD_API_BASE}/services", params=params)
 
         if resp.status_code == 429:
             wait = int(resp.headers.get("Retry-After", "5"))
-            print(f"Rate limit! Retrying after {wait}s...")
+            print(f"Rate limit! Waiting {wait}s ...")
             time.sleep(wait)
             continue
 
         resp.raise_for_status()
-        data = resp.json()
+        return resp.json()
 
-        for t in data.get("teams", []):
-            teams[t["id"]] = t["name"]
 
-        if not data.get("more"):
-            break
+def add_services_to_lookup(lookup, services):
+    for s in services:
+        sid = s.get("id")
+        sname = s.get("name")
 
-        offset += limit
-        time.sleep(0.2)
+        # Team(s) associated with the service
+        service_teams = s.get("teams", [])
 
-    print(f"Loaded {len(teams)} teams.")
-    return teams
+        if service_teams:
+            # include[]=teams embeds the team objects, names included
+            team = service_teams[0]
+            team_id = team.get("id")
+            team_name = team.get("summary") or team.get("name") or "UNKNOWN"
+        else:
+            team_id = "UNKNOWN"
+            team_name = "UNKNOWN"
+
+        integrations = s.get("integrations") or []
+
+        for integ in integrations:
+            key = integ.get("integration_key")
+            if key:
+                lookup[key] = {
+                    "service_id": sid,
+                    "service_name": sname,
+                    "team_id": team_id,
+                    "team_name": team_name
+                }
 
 
 def fetch_all_pd_services_with_integrations():
     print("Fetching ALL PagerDuty services + integrations + teams...")
     lookup = {}  # integration_key → {service_id, service_name, team_id, team_name}
-    limit = 100
-    offset = 0
 
-    teams_map = fetch_all_pd_teams()
-
-    while True:
-        params = {
-            "limit": limit,
-            "offset": offset,
-            "include[]": ["integrations", "teams"]
-        }
-        resp = session.get(f"{PD_API_BASE}/services", params=params)
+    # First page tells us the total, the rest are fetched concurrently
+    first = fetch_pd_services_page(0, total=True)
+    add_services_to_lookup(lookup, first.get("services", []))
+    total = first.get("total")
+
+    if total is not None:
+        offsets = range(PD_PAGE_LIMIT, total, PD_PAGE_LIMIT)
+        with ThreadPoolExecutor(max_workers=PD_MAX_WORKERS) as ex:
+            for data in ex.map(fetch_pd_services_page, offsets):
+                add_services_to_lookup(lookup, data.get("services", []))
+    else:
+        # No total reported, walk the pages one by one
+        data = first
+        offset = 0
+        while data.get("more"):
+            offset += PD_PAGE_LIMIT
+            data = fetch_pd_services_page(offset)
+            add_services_to_lookup(lookup, data.get("services", []))
 
-        if resp.status_code == 429:
-            wait = int(resp.headers.get("Retry-After", "5"))
-            print(f"Rate limit! Waiting {wait}s ...")
-            time.sleep(wait)
-            continue
-
-        resp.raise_for_status()
-        data = resp.json()
-        services = data.get("services", [])
-
-        for s in services:
-            sid = s.get("id")
-            sname = s.get("name")
-
-            # Team(s) associated with the service
-            service_teams = s.get("teams", [])
-
-            if service_teams:
-                team_id = service_teams[0].get("id")
-                team_name = teams_map.get(team_id, "UNKNOWN")
-            else:
-                team_id = "UNKNOWN"
-                team_name = "UNKNOWN"
-
-            integrations = s.get("integrations") or []
-
-            for integ in integrations:
-                key = integ.get("integration_key")
-                if key:
-                    lookup[key] = {
-                        "service_id": sid,
-                        "service_name": sname,
-                        "team_id": team_id,
-                        "team_name": team_name
-                    }
-
-        if not data.get("more"):
-            break
+    print(f"Loaded {len(lookup)} integration keys across all teams.")
+    return lookup
 
-        offset += limit
-        time.sleep(0.2)
+# mkstemp gives every writer its own temp file, so concurrent runs cannot
+# clobber each other before the atomic os.replace
+def write_file_atomic(path, text):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=path.parent)
+    with os.fdopen(fd, "w") as f:
+        f.write(text)
+    os.replace(tmp_path, path)
+
+def load_pd_lookup():
+    token_hash = hashlib.sha256(PD_TOKEN.encode()).hexdigest()
+    cache_path = Path(f"~/.cache/pd_mapping/{token_hash}.json").expanduser()
+
+    if PD_CACHE_TTL > 0 and cache_path.exists():
+        try:
+            age = time.time() - cache_path.stat().st_mtime
+            if age < PD_CACHE_TTL:
+                lookup = json.loads(cache_path.read_text())
+                print(f"Using cached PagerDuty lookup ({int(age)}s old): {cache_path}")
+                return lookup
+        except (OSError, ValueError) as e:
+            print(f"Warning: ignoring unreadable PagerDuty cache: {e}")
+
+    lookup = fetch_all_pd_services_with_integrations()
+
+    if PD_CACHE_TTL > 0:
+        try:
+            write_file_atomic(cache_path, json.dumps(lookup))
+        except OSError as e:
+            print(f"Warning: could not write PagerDuty cache: {e}")
 
-    print(f"Loaded {len(lookup)} integration keys across all teams.")
     return lookup
 
 #########################################
 # AWS Functions
 #########################################
 
+# AWS_REGIONS=us-east-1,eu-west-1 skips discovery; otherwise describe_regions
+# output is cached per AWS profile for REGIONS_CACHE_TTL seconds.
 def all_aws_regions():
+    override = os.environ.get("AWS_REGIONS")
+    if override:
+        return [r.strip() for r in override.split(",") if r.strip()]
+
+    profile = os.environ.get("AWS_PROFILE", "default")
+    cache_path = Path(f"~/.cache/pd_routing/regions-{profile}.json").expanduser()
+    try:
+        if time.time() - cache_path.stat().st_mtime < REGIONS_CACHE_TTL:
+            return json.loads(cache_path.read_text())
+    except (OSError, ValueError):
+        pass  # missing or unreadable cache: fall through to EC2
+
     ec2 = boto3.client("ec2", config=boto_config)
     resp = ec2.describe_regions(AllRegions=False)
-    return [r["RegionName"] for r in resp.get("Regions", [])]
+    regions = [r["RegionName"] for r in resp.get("Regions", [])]
+
+    try:
+        write_file_atomic(cache_path, json.dumps(regions))
+    except OSError as e:
+        print(f"Warning: could not write regions cache: {e}")
+    return regions
 
 def extract_key_from_pd(endpoint):
-    m = re.search(r"/integration/([^/]+)/?", endpoint)
+    m = _PD_KEY_RE.search(endpoint)
     return m.group(1) if m else None
 
+# boto3 sessions are not thread-safe, so each worker thread builds its own
+# session and keeps one client per (service, region).
+_thread_local = threading.local()
+
+def aws_client(service, region):
+    clients = getattr(_thread_local, "clients", None)
+    if clients is None:
+        _thread_local.session = boto3.session.Session()
+        clients = _thread_local.clients = {}
+
+    key = (service, region)
+    if key not in clients:
+        clients[key] = _thread_local.session.client(
+            service, region_name=region, config=boto_config
+        )
+    return clients[key]
+
 def cw_alarms(region):
-    cw = boto3.client("cloudwatch", region_name=region, config=boto_config)
-    paginator = cw.get_paginator("describe_alarms")
-    for page in paginator.paginate():
-        for a in page.get("MetricAlarms", []):
-            yield a
-
-def sns_subscriptions(topic_arn, region):
-    sns = boto3.client("sns", region_name=region, config=boto_config)
+    cw = aws_client("cloudwatch", region)
+    kwargs = {"MaxRecords": 100}
+    while True:
+        resp = cw.describe_alarms(**kwargs)
+        yield from resp.get("MetricAlarms", [])
+
+        token = resp.get("NextToken")
+        if not token:
+            break
+        kwargs["NextToken"] = token
+
+# sns is the region's client, shared with the lookup pool: botocore clients
+# are thread-safe for API calls, so pool threads never build their own.
+def sns_subscriptions(sns, topic_arn):
     subs = []
     paginator = sns.get_paginator("list_subscriptions_by_topic")
     for page in paginator.paginate(TopicArn=topic_arn):
@@ -161,100 +295,160 @@ def sns_subscriptions(topic_arn, region):
     return subs
 
 #########################################
-# Main
+# Region Scan
 #########################################
 
-def main():
-    # Load PagerDuty lookup (all teams/services)
-    pd_lookup = fetch_all_pd_services_with_integrations()
+def scan_region(region, pd_lookup):
+    print(f"Scanning region: {region}")
+    rows = []  # plain tuples in COLUMNS order
+    alarms = list(cw_alarms(region))
+
+    # Fetch subscriptions once per distinct topic, concurrently
+    unique_arns = {
+        arn
+        for alarm in alarms
+        for arn in alarm.get("AlarmActions") or []
+        if isinstance(arn, str) and arn.startswith("arn:aws:sns:")
+    }
+    subs_by_arn = {}
+    if unique_arns:
+        sns = aws_client("sns", region)
+        with ThreadPoolExecutor(max_workers=min(MAX_SNS_WORKERS, len(unique_arns))) as ex:
+            futures = {ex.submit(sns_subscriptions, sns, arn): arn for arn in unique_arns}
+            for future in as_completed(futures):
+                subs_by_arn[futures[future]] = future.result()
+
+    for alarm in alarms:
+        alarm_name = alarm.get("AlarmName", "<no-name>")
+        actions = alarm.get("AlarmActions") or []
+
+        if not actions:
+            rows.append((region, alarm_name, "NO_ACTION", "", "", "", "", "", "", ""))
+            continue
 
-    regions = all_aws_regions()
-    print(f"Regions found: {regions}")
+        action_status = "ENABLED" if alarm.get("ActionsEnabled", False) else "DISABLED"
 
-    rows = []
-
-    for region in regions:
-        print(f"\nScanning region: {region}")
-        for alarm in cw_alarms(region):
-            alarm_name = alarm.get("AlarmName", "<no-name>")
-            actions = alarm.get("AlarmActions") or []
-
-            if not actions:
-                rows.append({
-                    "Region": region,
-                    "AlarmName": alarm_name,
-                    "AlarmActionStatus": "NO_ACTION",
-                    "SNSTopicArn": "",
-                    "SNSTopicName": "",
-                    "IntegrationKey": "",
-                    "PagerDutyServiceName": "",
-                    "PagerDutyServiceID": "",
-                    "PagerDutyTeamName": "",
-                    "PagerDutyTeamID": ""
-                })
-                continue
+        sns_arns = [a for a in actions if isinstance(a, str) and a.startswith("arn:aws:sns:")]
+        if not sns_arns:
+            # Only non-SNS actions (Lambda, Auto Scaling, SSM, ...)
+            rows.append((region, alarm_name, action_status, "", "", "", "", "", "", ""))
+            continue
 
-            action_status = "ENABLED" if alarm.get("ActionsEnabled", False) else "DISABLED"
+        for sns_arn in sns_arns:
+            sns_name = sns_arn.rsplit(":", 1)[-1]
 
-            for arn in actions:
-                if not isinstance(arn, str) or not arn.startswith("arn:aws:sns:"):
+            subs = subs_by_arn[sns_arn]
+            pd_found = False
+
+            # Check each subscription
+            for sub in subs:
+                endpoint = sub.get("Endpoint", "")
+                if endpoint.startswith(PD_INTEGRATION_PREFIX):
+                    key = endpoint[len(PD_INTEGRATION_PREFIX):].split("/", 1)[0]
+                elif "pagerduty" in endpoint:
+                    # Other PagerDuty URL shapes (e.g. EU service region)
+                    key = extract_key_from_pd(endpoint)
+                else:
                     continue
 
-                sns_arn = arn
-                sns_name = sns_arn.rsplit(":", 1)[-1]
+                if not key:
+                    continue
 
-                subs = sns_subscriptions(sns_arn, region)
-                pd_found = False
+                pd_found = True
+                pd_info = pd_lookup.get(key, {
+                    "service_id": "NOT_FOUND",
+                    "service_name": "NOT_FOUND",
+                    "team_id": "UNKNOWN",
+                    "team_name": "UNKNOWN"
+                })
 
-                # Check each subscription
-                for sub in subs:
-                    endpoint = sub.get("Endpoint", "")
-                    if "pagerduty" not in endpoint:
-                        continue
+                rows.append((
+                    region,
+                    alarm_name,
+                    action_status,
+                    sns_arn,
+                    sns_name,
+                    key,
+                    pd_info["service_name"],
+                    pd_info["service_id"],
+                    pd_info["team_name"],
+                    pd_info["team_id"]
+                ))
+
+            if not pd_found:
+                rows.append((region, alarm_name, action_status, sns_arn, sns_name,
+                             "", "", "", "", ""))
+
+    print(f"  finished {region}: {len(rows)} rows")
+    return rows
 
-                    key = extract_key_from_pd(endpoint)
-                    if not key:
-                        continue
-
-                    pd_found = True
-                    pd_info = pd_lookup.get(key, {
-                        "service_id": "NOT_FOUND",
-                        "service_name": "NOT_FOUND",
-                        "team_id": "UNKNOWN",
-                        "team_name": "UNKNOWN"
-                    })
-
-                    rows.append({
-                        "Region": region,
-                        "AlarmName": alarm_name,
-                        "AlarmActionStatus": action_status,
-                        "SNSTopicArn": sns_arn,
-                        "SNSTopicName": sns_name,
-                        "IntegrationKey": key,
-                        "PagerDutyServiceName": pd_info["service_name"],
-                        "PagerDutyServiceID": pd_info["service_id"],
-                        "PagerDutyTeamName": pd_info["team_name"],
-                        "PagerDutyTeamID": pd_info["team_id"]
-                    })
-
-                if not pd_found:
-                    rows.append({
-                        "Region": region,
-                        "AlarmName": alarm_name,
-                        "AlarmActionStatus": action_status,
-                        "SNSTopicArn": sns_arn,
-                        "SNSTopicName": sns_name,
-                        "IntegrationKey": "",
-                        "PagerDutyServiceName": "",
-                        "PagerDutyServiceID": "",
-                        "PagerDutyTeamName": "",
-                        "PagerDutyTeamID": ""
-                    })
-
-    # DataFrame → Excel
-    df = pd.DataFrame(rows)
-    print(f"\nWriting Excel: {OUTPUT_XLSX}")
-    df.to_excel(OUTPUT_XLSX, index=False)
+#########################################
+# Output
+#########################################
+
+# Yields write_row for OUTPUT_FORMAT. Rows stream into a temp file next to
+# the report, which replaces the previous report only if the scan finishes;
+# on error the temp file is discarded and the old report is left intact.
+@contextmanager
+def open_output():
+    path = OUTPUT_CSV if OUTPUT_FORMAT == "csv" else OUTPUT_XLSX
+    fd, tmp_path = tempfile.mkstemp(suffix=Path(path).suffix, dir=Path(path).resolve().parent)
+    try:
+        if OUTPUT_FORMAT == "csv":
+            print(f"\nWriting CSV: {path}")
+            with os.fdopen(fd, "w", newline="") as f:
+                writer = csv.writer(f)
+                writer.writerow(COLUMNS)
+                yield writer.writerow
+        else:
+            os.close(fd)
+            # constant_memory flushes each row to disk as soon as the next one starts
+            print(f"\nWriting Excel: {path}")
+            wb = xlsxwriter.Workbook(tmp_path, {"constant_memory": True})
+            ws = wb.add_worksheet()
+            ws.write_row(0, 0, COLUMNS)
+            row_numbers = itertools.count(1)
+
+            def write_row(row):
+                ws.write_row(next(row_numbers), 0, row)
+
+            # always close, or the destructor would rewrite the discarded file
+            try:
+                yield write_row
+            finally:
+                wb.close()
+        # mkstemp creates the file 0600; give the report the usual umask mode
+        umask = os.umask(0)
+        os.umask(umask)
+        os.chmod(tmp_path, 0o666 & ~umask)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+#########################################
+# Main
+#########################################
+
+def main():
+    # Load PagerDuty lookup (all teams/services)
+    pd_lookup = load_pd_lookup()
+
+    regions = all_aws_regions()
+    print(f"Regions found: {regions}")
+
+    row_count = 0
+
+    with open_output() as write_row, \
+            ThreadPoolExecutor(max_workers=max(1, min(MAX_REGION_WORKERS, len(regions)))) as ex:
+        # map() still streams, but yields regions in order so reports diff cleanly
+        for rows in ex.map(scan_region, regions, itertools.repeat(pd_lookup)):
+            for row in rows:
+                write_row(row)
+                row_count += 1
+
+    print(f"Wrote {row_count} rows.")
     print("Done.")
 
 if __name__ == "__main__":
@@ -1,25 +1,57 @@
 import boto3
 import csv
+import json
+import os
+import time
+import tempfile
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
 
-# Get all AWS regions
-ec2 = boto3.client("ec2")
-regions = [r["RegionName"] for r in ec2.describe_regions()["Regions"]]
+REGIONS_CACHE_TTL = 86400
+
+# Get all AWS regions: AWS_REGIONS override, then a day-old cache, then EC2
+if os.environ.get("AWS_REGIONS"):
+    regions = [r.strip() for r in os.environ["AWS_REGIONS"].split(",") if r.strip()]
+else:
+    profile = os.environ.get("AWS_PROFILE", "default")
+    cache_path = Path(f"~/.cache/pd_routing/regions-{profile}.json").expanduser()
+
+    regions = None
+    try:
+        if time.time() - cache_path.stat().st_mtime < REGIONS_CACHE_TTL:
+            regions = json.loads(cache_path.read_text())
+    except (OSError, ValueError):
+        pass  # missing or unreadable cache: fall through to EC2
+
+    if regions is None:
+        ec2 = boto3.client("ec2")
+        regions = [r["RegionName"] for r in ec2.describe_regions()["Regions"]]
+
+        # all.py shares this file, so replace it atomically via a temp file
+        try:
+            cache_path.parent.mkdir(parents=True, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=cache_path.parent)
+            with os.fdopen(fd, "w") as f:
+                json.dump(regions, f)
+            os.replace(tmp_path, cache_path)
+        except OSError as e:
+            print(f"Warning: could not write regions cache: {e}")
 
-all_rows = []
 
-for region in regions:
+def fetch_region(region):
     print(f"Processing region: {region}")
 
-    cw = boto3.client("cloudwatch", region_name=region)
+    # boto3 sessions are not thread-safe, so each worker gets its own
+    cw = boto3.session.Session().client("cloudwatch", region_name=region)
 
     alarms = []
     next_token = None
 
     while True:
         if next_token:
-            resp = cw.describe_alarms(NextToken=next_token)
+            resp = cw.describe_alarms(MaxRecords=100, NextToken=next_token)
         else:
-            resp = cw.describe_alarms()
+            resp = cw.describe_alarms(MaxRecords=100)
 
         alarms.extend(resp["MetricAlarms"])
         next_token = resp.get("NextToken")
@@ -28,6 +60,7 @@ for region in regions:
             break
 
     # Process alarms in this region
+    rows = []
     for alarm in alarms:
         name = alarm.get("AlarmName")
         enabled = alarm.get("ActionsEnabled")
@@ -40,7 +73,17 @@ for region in regions:
             status = "Enabled" if enabled else "Disabled"
             action_arns = ";".join(actions)
 
-        all_rows.append([region, name, status, action_arns])
+        rows.append([region, name, status, action_arns])
+
+    return rows
+
+
+all_rows = []
+
+# Regions are scanned concurrently; map() keeps the output in region order
+with ThreadPoolExecutor(max_workers=max(1, min(16, len(regions)))) as ex:
+    for batch in ex.map(fetch_region, regions):
+        all_rows.extend(batch)
 
 
 # Write final CSV
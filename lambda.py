@@ -1,11 +1,27 @@
 import json
-import urllib.request
-import urllib.parse
+import urllib3
 import logging
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
+# orjson ships as a Lambda layer; fall back to the stdlib when it is absent
+try:
+    import orjson
+
+    def to_json_bytes(payload, indent=False):
+        return orjson.dumps(payload, option=orjson.OPT_INDENT_2 if indent else None)
+except ImportError:
+    def to_json_bytes(payload, indent=False):
+        return json.dumps(payload, indent=2 if indent else None).encode("utf-8")
+
+# Module-level pool so warm invocations reuse the keep-alive connection to Slack
+_http = urllib3.PoolManager(
+    num_pools=1,
+    maxsize=4,
+    retries=urllib3.Retry(total=3, backoff_factor=0.2)
+)
+
 def lambda_handler(event, context):
     """
     Reads an AWS event (your provided JSON) and posts a summary to Slack.
@@ -15,7 +31,7 @@ def lambda_handler(event, context):
     slack_url = "https://hooks.slack.com/"
 
     # The 'event' parameter will automatically contain your provided JSON data
-    event_summary = f"Received AWS Scheduled Event:\n*Rule ARN:* {event['resources'][0]}\n*Region:* {event['region']}\n*Time:* {event['time']}\n\n*Full Details:*\n```\n{json.dumps(event, indent=4)}\n```"
+    event_summary = f"Received AWS Scheduled Event:\n*Rule ARN:* {event['resources'][0]}\n*Region:* {event['region']}\n*Time:* {event['time']}\n\n*Full Details:*\n```\n{to_json_bytes(event, indent=True).decode('utf-8')}\n```"
 
     slack_data = {
         'text': event_summary,
@@ -24,23 +40,23 @@ def lambda_handler(event, context):
         'mrkdwn': True
     }
 
-    json_data = json.dumps(slack_data)
-    data = json_data.encode('utf-8')
+    data = to_json_bytes(slack_data)
 
     try:
-        req = urllib.request.Request(
+        response = _http.request(
+            'POST',
             slack_url,
-            data=data,
+            body=data,
             headers={'Content-Type': 'application/json'}
         )
 
-        with urllib.request.urlopen(req) as response:
-            logger.info("Message posted to Slack successfully.")
-            return {'statusCode': 200, 'body': json.dumps('Message sent to Slack')}
+        if response.status >= 400:
+            logger.error(f"Request failed: {response.status} {response.reason}")
+            return {'statusCode': response.status, 'body': json.dumps(f'Error sending to Slack: {response.reason}')}
+
+        logger.info("Message posted to Slack successfully.")
+        return {'statusCode': 200, 'body': json.dumps('Message sent to Slack')}
 
-    except urllib.error.HTTPError as e:
-        logger.error(f"Request failed: {e.code} {e.reason}")
-        return {'statusCode': e.code, 'body': json.dumps(f'Error sending to Slack: {e.reason}')}
     except Exception as e:
         logger.error(f"An unexpected error occurred: {e}")
         return {'statusCode': 500, 'body': json.dumps(f'An unexpected error occurred: {e}')}
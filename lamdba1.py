@@ -1,12 +1,41 @@
 import json
-import urllib.request
+import urllib3
 import logging
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
+# orjson ships as a Lambda layer; fall back to the stdlib when it is absent
+try:
+    import orjson
+
+    def to_json_bytes(payload):
+        return orjson.dumps(payload)
+except ImportError:
+    def to_json_bytes(payload):
+        return json.dumps(payload).encode("utf-8")
+
 SLACK_WEBHOOK_URL = "https://hooks.slack.com/services/XXX/YYY/ZZZ"
 
+# Module-level pool so warm invocations reuse the keep-alive connection to Slack
+_http = urllib3.PoolManager(
+    num_pools=1,
+    maxsize=4,
+    retries=urllib3.Retry(total=3, backoff_factor=0.2)
+)
+
+
+def post_to_slack(payload):
+    resp = _http.request(
+        "POST",
+        SLACK_WEBHOOK_URL,
+        body=to_json_bytes(payload),
+        headers={"Content-Type": "application/json"}
+    )
+    if resp.status >= 400:
+        raise RuntimeError(f"HTTP Error {resp.status}: {resp.reason}")
+    return resp
+
 
 def field(label, value):
     return {
@@ -93,13 +122,7 @@ def lambda_handler(event, context):
 
     # ---- SEND TO SLACK ----
     try:
-        req = urllib.request.Request(
-            SLACK_WEBHOOK_URL,
-            data=json.dumps(slack_payload).encode("utf-8"),
-            headers={"Content-Type": "application/json"}
-        )
-
-        urllib.request.urlopen(req)
+        post_to_slack(slack_payload)
         logger.info("Slack message sent")
 
         return {
@@ -5,29 +5,66 @@ full_pd_aws_mapping.py
 Scans AWS CloudWatch alarms -> SNS topics -> PagerDuty integration keys,
 maps keys to PagerDuty services limited to a specific team (PB0IV0T),
 and writes results to an Excel file: cloudwatch_pd_mapping.xlsx
+(or cloudwatch_pd_mapping.csv with --format csv)
 
 Requirements:
-  pip install boto3 requests pandas openpyxl
+  pip install boto3 requests xlsxwriter
+  pip install orjson   (optional, faster PagerDuty JSON decoding)
 Environment:
   PD_TOKEN must be set in environment before running.
+  PD_CACHE_TTL (optional, default 600) seconds to reuse the cached
+  PagerDuty services; pass --force-refresh to ignore the cache.
 """
 
 import os
-import re
 import time
 import math
 import sys
+import json
+import csv
+import itertools
+import tempfile
+import argparse
+import threading
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import boto3
 import requests
-import pandas as pd
+import xlsxwriter
 from botocore.config import Config
 from botocore.exceptions import ClientError
 
+# orjson is optional; it decodes large PagerDuty pages noticeably faster
+try:
+    import orjson
+
+    def parse_json(resp):
+        return orjson.loads(resp.content)
+except ImportError:
+    def parse_json(resp):
+        return resp.json()
+
 # Configuration
 PD_TEAM_ID = "PB0IV0T"
 OUTPUT_XLSX = "cloudwatch_pd_mapping.xlsx"
+OUTPUT_CSV = "cloudwatch_pd_mapping.csv"
+COLUMNS = (
+    "Region",
+    "AlarmName",
+    "AlarmActionStatus",
+    "SNSTopicArn",
+    "SNSTopicName",
+    "IntegrationKey",
+    "PagerDutyServiceName",
+    "PagerDutyServiceID"
+)
 PD_API_BASE = "https://api.pagerduty.com"
+PD_INTEGRATION_PREFIX = "https://events.pagerduty.com/integration/"
 PD_TOKEN = os.environ.get("PD_TOKEN")  # required
+PD_PAGE_LIMIT = 100  # max reasonable page size
+PD_MAX_WORKERS = 8  # PagerDuty allows 2000 requests/min
+PD_CACHE_DIR = os.path.expanduser("~/.cache/pd_routing")
+PD_CACHE_TTL = int(os.environ.get("PD_CACHE_TTL", "600"))  # seconds
 
 if not PD_TOKEN:
     print("ERROR: PD_TOKEN environment variable not set. export PD_TOKEN=your_token")
@@ -37,8 +74,30 @@ if not PD_TOKEN:
 boto_config = Config(retries={"max_attempts": 6, "mode": "standard"})
 
 ec2 = boto3.client("ec2", config=boto_config)
-cloudwatch = boto3.client("cloudwatch", config=boto_config)
-sns = boto3.client("sns", config=boto_config)
+
+# Region scans run on worker threads; boto3 sessions are not thread-safe,
+# so each thread builds (and reuses) clients from its own session.
+MAX_REGION_WORKERS = 16
+MAX_SNS_WORKERS = 32
+# The SNS client is shared by the whole lookup pool, so size its connection
+# pool to match (botocore defaults to 10)
+sns_config = boto_config.merge(Config(max_pool_connections=MAX_SNS_WORKERS))
+_thread_local = threading.local()
+
+def regional_client(service, region, config=boto_config):
+    """
+    Returns the current thread's boto3 client for (service, region),
+    building it with config on first use.
+    """
+    if not hasattr(_thread_local, "session"):
+        _thread_local.session = boto3.session.Session()
+        _thread_local.clients = {}
+    key = (service, region)
+    if key not in _thread_local.clients:
+        _thread_local.clients[key] = _thread_local.session.client(
+            service, region_name=region, config=config
+        )
+    return _thread_local.clients[key]
 
 session = requests.Session()
 session.headers.update({
@@ -46,52 +105,108 @@ session.headers.update({
     "Authorization": f"Token token={PD_TOKEN}"
 })
 
-def fetch_pagerduty_services_for_team(team_id):
+def fetch_services_page(team_id, offset, total=False):
     """
-    Returns dict mapping integration_key -> (service_id, service_name)
-    for all services that belong to the specified team.
-    Uses offset-based pagination.
+    Fetches one page of services for a team, retrying after 429s.
     """
-    print(f"Fetching PagerDuty services for team {team_id} ...")
-    lookup = {}
-    limit = 100  # max reasonable page size
-    offset = 0
-
+    params = {
+        "team_ids[]": team_id,
+        "include[]": "integrations",
+        "limit": PD_PAGE_LIMIT,
+        "offset": offset
+    }
+    if total:
+        params["total"] = "true"
     while True:
-        params = {
-            "team_ids[]": team_id,
-            "include[]": "integrations",
-            "limit": limit,
-            "offset": offset
-        }
         resp = session.get(f"{PD_API_BASE}/services", params=params, timeout=30)
         if resp.status_code == 429:
-            # rate limited - back off and retry
+            # rate limited - back off and retry this page
             wait = int(resp.headers.get("Retry-After", "5"))
             print(f"PagerDuty rate limited. Sleeping {wait}s.")
             time.sleep(wait)
             continue
         resp.raise_for_status()
-        data = resp.json()
-        services = data.get("services", [])
-        for s in services:
-            sid = s.get("id")
-            sname = s.get("name")
-            integrations = s.get("integrations") or []
-            for integ in integrations:
-                key = integ.get("integration_key") or integ.get("integration_key")  # guard
-                if key:
-                    lookup[key] = (sid, sname)
-        # PagerDuty returns 'more' flag and offset; compute next offset
-        more = data.get("more", False)
-        if not more:
-            break
-        offset += limit
-        # small throttle to avoid being rate-limited
-        time.sleep(0.2)
+        return parse_json(resp)
+
+def add_services_to_lookup(lookup, services):
+    for s in services:
+        sid = s.get("id")
+        sname = s.get("name")
+        integrations = s.get("integrations") or []
+        for integ in integrations:
+            key = integ.get("integration_key")
+            if key:
+                lookup[key] = (sid, sname)
+
+def fetch_pagerduty_services_for_team(team_id):
+    """
+    Returns dict mapping integration_key -> (service_id, service_name)
+    for all services that belong to the specified team.
+    The first page reports the total; remaining pages are fetched
+    concurrently by offset.
+    """
+    print(f"Fetching PagerDuty services for team {team_id} ...")
+    lookup = {}
+
+    first = fetch_services_page(team_id, 0, total=True)
+    add_services_to_lookup(lookup, first.get("services", []))
+    total = first.get("total")
+
+    if total is not None:
+        n_pages = math.ceil(total / PD_PAGE_LIMIT)
+        offsets = [page * PD_PAGE_LIMIT for page in range(1, n_pages)]
+        with ThreadPoolExecutor(max_workers=PD_MAX_WORKERS) as ex:
+            for data in ex.map(lambda offset: fetch_services_page(team_id, offset), offsets):
+                add_services_to_lookup(lookup, data.get("services", []))
+    else:
+        # no total reported - fall back to walking the 'more' flag
+        data = first
+        offset = 0
+        while data.get("more", False):
+            offset += PD_PAGE_LIMIT
+            data = fetch_services_page(team_id, offset)
+            add_services_to_lookup(lookup, data.get("services", []))
+
     print(f"Loaded {len(lookup)} integration keys from PagerDuty (team {team_id}).")
     return lookup
 
+def write_file_atomic(path, text):
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+    with os.fdopen(fd, "w") as f:
+        f.write(text)
+    os.replace(tmp_path, path)
+
+def load_pagerduty_services_for_team(team_id, force_refresh=False):
+    """
+    Cached wrapper around fetch_pagerduty_services_for_team.
+    Reuses ~/.cache/pd_routing/services_<team>.json while the timestamp in
+    its sibling .meta file is younger than PD_CACHE_TTL.
+    """
+    data_path = os.path.join(PD_CACHE_DIR, f"services_{team_id}.json")
+    meta_path = os.path.join(PD_CACHE_DIR, f"services_{team_id}.meta")
+
+    if not force_refresh and os.path.exists(data_path) and os.path.exists(meta_path):
+        try:
+            with open(meta_path) as f:
+                age = time.time() - json.load(f)["generated_at"]
+            if age < PD_CACHE_TTL:
+                with open(data_path) as f:
+                    lookup = {k: tuple(v) for k, v in json.load(f).items()}
+                print(f"Using cached PagerDuty services for team {team_id} ({int(age)}s old).")
+                return lookup
+        except (OSError, ValueError, KeyError) as e:
+            print(f"Warning: ignoring unreadable PagerDuty cache: {e}")
+
+    lookup = fetch_pagerduty_services_for_team(team_id)
+
+    try:
+        os.makedirs(PD_CACHE_DIR, exist_ok=True)
+        write_file_atomic(data_path, json.dumps(lookup))
+        write_file_atomic(meta_path, json.dumps({"generated_at": time.time()}))
+    except OSError as e:
+        print(f"Warning: could not write PagerDuty cache: {e}")
+    return lookup
+
 def all_aws_regions():
     """Return list of region names from EC2 describe-regions"""
     resp = ec2.describe_regions(AllRegions=False)
@@ -104,18 +219,18 @@ def extract_integration_key_from_url(url):
       https://events.pagerduty.com/integration/<key>/enqueue
     Returns None if not found.
     """
-    if not url:
+    if not url or "/integration/" not in url:
         return None
-    m = re.search(r"/integration/([^/]+)/?", url)
-    if m:
-        return m.group(1)
-    return None
+    tail = url.split("/integration/", 1)[1]
+    key, _, _ = tail.partition("/")
+    return key or None
 
-def list_subscriptions_by_topic(topic_arn, region):
+def list_subscriptions_by_topic(client, topic_arn, region):
     """
     Returns list of subscription dicts for a topic, paginated.
+    client is the region's SNS client; botocore clients are safe to share
+    between threads for API calls.
     """
-    client = boto3.client("sns", region_name=region, config=boto_config)
     subs = []
     paginator = client.get_paginator("list_subscriptions_by_topic")
     try:
@@ -130,12 +245,17 @@ def describe_alarms_paginated(region):
     """
     Uses paginator to yield MetricAlarms across pages for a region.
     """
-    client = boto3.client("cloudwatch", region_name=region, config=boto_config)
+    client = regional_client("cloudwatch", region)
     paginator = client.get_paginator("describe_alarms")
     try:
-        for page in paginator.paginate():
-            for alarm in page.get("MetricAlarms", []) or []:
-                yield alarm
+        # DescribeAlarms already returns only metric alarms when AlarmTypes
+        # is omitted; the filter just makes that explicit
+        pages = paginator.paginate(
+            AlarmTypes=["MetricAlarm"],
+            PaginationConfig={"PageSize": 100}
+        )
+        for page in pages:
+            yield from page.get("MetricAlarms", [])
     except ClientError as e:
         print(f"Warning: error describing alarms in {region}: {e}")
         return
@@ -149,98 +269,193 @@ def safe_len_alarm_actions(alarm):
         return 0
     return len(actions)
 
-def main():
-    pd_lookup = fetch_pagerduty_services_for_team(PD_TEAM_ID)
-    regions = all_aws_regions()
-    print(f"Found {len(regions)} regions: {regions}")
-
+def scan_region(region, pd_future):
+    """
+    Scans one region's alarms and returns its rows as tuples in COLUMNS order.
+    pd_future resolves to the PagerDuty lookup; it is only awaited once the
+    region's AWS data has been fetched.
+    """
+    print(f"Scanning region: {region}")
     rows = []
+    alarms = list(describe_alarms_paginated(region))
+    if pd_future.done():
+        pd_future.result()  # PagerDuty already failed: skip the SNS lookups
 
-    for region in regions:
-        print(f"\nScanning region: {region}")
-        alarm_count = 0
-        for alarm in describe_alarms_paginated(region):
-            alarm_count += 1
-            alarm_name = alarm.get("AlarmName", "<no-name>")
-            # Determine action status
-            actions_count = safe_len_alarm_actions(alarm)
-            if actions_count == 0:
-                rows.append({
-                    "Region": region,
-                    "AlarmName": alarm_name,
-                    "AlarmActionStatus": "NO_ACTION",
-                    "SNSTopicArn": "",
-                    "SNSTopicName": "",
-                    "IntegrationKey": "",
-                    "PagerDutyServiceName": "",
-                    "PagerDutyServiceID": ""
-                })
-                continue
+    # First pass: fetch subscriptions for every distinct SNS topic concurrently
+    topic_arns = {
+        arn
+        for alarm in alarms
+        for arn in (alarm.get("AlarmActions") or [])
+        if isinstance(arn, str) and arn.startswith("arn:aws:sns:")
+    }
+    subs_by_topic = {}
+    if topic_arns:
+        # Built once on the region thread and shared with the lookup pool,
+        # so short-lived pool threads never construct sessions or clients
+        sns_client = regional_client("sns", region, sns_config)
+
+        # Every topic goes through ListSubscriptionsByTopic: ListSubscriptions
+        # omits subscriptions owned by other accounts, so a sweep cannot be
+        # trusted to show all of a topic's PagerDuty endpoints
+        with ThreadPoolExecutor(max_workers=min(MAX_SNS_WORKERS, len(topic_arns))) as ex:
+            futures = {ex.submit(list_subscriptions_by_topic, sns_client, arn, region): arn for arn in topic_arns}
+            for future in as_completed(futures):
+                subs_by_topic[futures[future]] = future.result()
 
-            action_enabled = alarm.get("ActionsEnabled", False)
-            action_status = "ENABLED" if action_enabled else "DISABLED"
+    pd_lookup = pd_future.result()
 
-            # AlarmActions can include many ARNs (SNS, AutoScaling, etc.)
-            for arn in (alarm.get("AlarmActions") or []):
-                if not isinstance(arn, str):
+    # Second pass: build rows from the prefetched subscriptions
+    alarm_count = 0
+    for alarm in alarms:
+        alarm_count += 1
+        alarm_name = alarm.get("AlarmName", "<no-name>")
+        # Determine action status
+        actions_count = safe_len_alarm_actions(alarm)
+        if actions_count == 0:
+            rows.append((region, alarm_name, "NO_ACTION", "", "", "", "", ""))
+            continue
+
+        action_enabled = alarm.get("ActionsEnabled", False)
+        action_status = "ENABLED" if action_enabled else "DISABLED"
+
+        # AlarmActions can include many ARNs (SNS, AutoScaling, etc.)
+        for arn in (alarm.get("AlarmActions") or []):
+            if not isinstance(arn, str):
+                continue
+            if not arn.startswith("arn:aws:sns:"):
+                # skip non-SNS actions
+                continue
+            sns_arn = arn
+            sns_name = sns_arn[sns_arn.rfind(":") + 1:] or sns_arn
+            subs = subs_by_topic[sns_arn]
+            # find PD subscriptions
+            found_pd = False
+            for sub in subs:
+                endpoint = sub.get("Endpoint") or ""
+                if endpoint.startswith(PD_INTEGRATION_PREFIX):
+                    key = endpoint[len(PD_INTEGRATION_PREFIX):].split("/", 1)[0]
+                elif "pagerduty" in endpoint:
+                    # other PagerDuty hosts (e.g. events.eu.pagerduty.com)
+                    key = extract_integration_key_from_url(endpoint)
+                else:
                     continue
-                if not arn.startswith("arn:aws:sns:"):
-                    # skip non-SNS actions
+                if not key:
                     continue
-                sns_arn = arn
-                sns_name = sns_arn.split(":")[-1] if ":" in sns_arn else sns_arn
-                # list subscriptions for this topic
-                subs = list_subscriptions_by_topic(sns_arn, region)
-                # find PD subscriptions
-                found_pd = False
-                for sub in subs:
-                    endpoint = sub.get("Endpoint") or ""
-                    if "pagerduty" not in endpoint:
-                        continue
-                    key = extract_integration_key_from_url(endpoint)
-                    if not key:
-                        continue
-                    found_pd = True
-                    service_id, service_name = pd_lookup.get(key, ("NOT_FOUND", "NOT_FOUND"))
-                    rows.append({
-                        "Region": region,
-                        "AlarmName": alarm_name,
-                        "AlarmActionStatus": action_status,
-                        "SNSTopicArn": sns_arn,
-                        "SNSTopicName": sns_name,
-                        "IntegrationKey": key,
-                        "PagerDutyServiceName": service_name,
-                        "PagerDutyServiceID": service_id
-                    })
-                if not found_pd:
-                    # SNS topic exists but no PD subscriptions
-                    rows.append({
-                        "Region": region,
-                        "AlarmName": alarm_name,
-                        "AlarmActionStatus": action_status,
-                        "SNSTopicArn": sns_arn,
-                        "SNSTopicName": sns_name,
-                        "IntegrationKey": "",
-                        "PagerDutyServiceName": "",
-                        "PagerDutyServiceID": ""
-                    })
-        print(f"  scanned {alarm_count} alarms in {region}")
-
-    # Build dataframe and export to Excel
-    df = pd.DataFrame(rows, columns=[
-        "Region",
-        "AlarmName",
-        "AlarmActionStatus",
-        "SNSTopicArn",
-        "SNSTopicName",
-        "IntegrationKey",
-        "PagerDutyServiceName",
-        "PagerDutyServiceID"
-    ])
-
-    # Save to Excel
-    print(f"\nWriting {len(df)} rows to {OUTPUT_XLSX} ...")
-    df.to_excel(OUTPUT_XLSX, index=False)
+                found_pd = True
+                hit = pd_lookup.get(key)
+                if hit is None:
+                    service_id, service_name = "NOT_FOUND", "NOT_FOUND"
+                else:
+                    service_id, service_name = hit
+                rows.append((
+                    region,
+                    alarm_name,
+                    action_status,
+                    sns_arn,
+                    sns_name,
+                    key,
+                    service_name,
+                    service_id
+                ))
+            if not found_pd:
+                # SNS topic exists but no PD subscriptions
+                rows.append((region, alarm_name, action_status, sns_arn, sns_name, "", "", ""))
+    print(f"  scanned {alarm_count} alarms in {region}")
+    return rows
+
+@contextmanager
+def open_output(fmt):
+    """
+    Streams rows for the given format into a temp file next to the final
+    output, yielding (path, write_row). The temp file replaces the previous
+    report only if the scan completes; on error it is discarded.
+    """
+    path = OUTPUT_CSV if fmt == "csv" else OUTPUT_XLSX
+    fd, tmp_path = tempfile.mkstemp(suffix=os.path.splitext(path)[1],
+                                    dir=os.path.dirname(os.path.abspath(path)))
+    try:
+        if fmt == "csv":
+            with os.fdopen(fd, "w", newline="") as f:
+                writer = csv.writer(f)
+                writer.writerow(COLUMNS)
+                yield path, writer.writerow
+        else:
+            os.close(fd)
+            # constant_memory mode flushes every row to disk, so memory stays
+            # bounded by one region's rows
+            workbook = xlsxwriter.Workbook(tmp_path, {"constant_memory": True})
+            worksheet = workbook.add_worksheet("mapping")
+            worksheet.write_row(0, 0, COLUMNS)
+            row_numbers = itertools.count(1)
+
+            def write_row(row):
+                worksheet.write_row(next(row_numbers), 0, row)
+
+            # always close, or the workbook's destructor would write the
+            # temp file again after it has been discarded
+            try:
+                yield path, write_row
+            finally:
+                workbook.close()
+        # mkstemp creates the file 0600; give the report the usual umask mode
+        umask = os.umask(0)
+        os.umask(umask)
+        os.chmod(tmp_path, 0o666 & ~umask)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Map CloudWatch alarms to PagerDuty services.")
+    parser.add_argument("--regions", help="comma-separated regions to scan (default: all enabled)")
+    parser.add_argument("--force-refresh", action="store_true",
+                        help="ignore the cached PagerDuty services and re-fetch them")
+    parser.add_argument("--format", choices=("xlsx", "csv"),
+                        default="xlsx",
+                        help="output format; csv skips the XLSX encoding entirely")
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+
+    # PagerDuty and AWS lookups are independent, so load PagerDuty in the
+    # background while regions are scanned; wall time becomes the slower
+    # of the two rather than their sum.
+    with ThreadPoolExecutor(max_workers=1) as pd_executor:
+        pd_future = pd_executor.submit(
+            load_pagerduty_services_for_team, PD_TEAM_ID, args.force_refresh
+        )
+
+        if args.regions:
+            regions = [r.strip() for r in args.regions.split(",") if r.strip()]
+        else:
+            regions = all_aws_regions()
+        print(f"Found {len(regions)} regions: {regions}")
+
+        with ThreadPoolExecutor(max_workers=max(1, min(MAX_REGION_WORKERS, len(regions)))) as ex:
+            # map() submits every region up front and yields results in region
+            # order, so consecutive reports can be diffed
+            results = ex.map(scan_region, regions, itertools.repeat(pd_future))
+
+            # Fail fast on PagerDuty errors (e.g. 401 for a bad PD_TOKEN):
+            # drop queued regions and stop before any output is opened
+            pd_error = pd_future.exception()
+            if pd_error is not None:
+                ex.shutdown(wait=False, cancel_futures=True)
+                raise pd_error
+
+            # Stream rows to the output as each region completes, in order
+            with open_output(args.format) as (output_path, write_row):
+                print(f"\nWriting {output_path} ...")
+                row_count = 0
+                for rows in results:
+                    for row in rows:
+                        write_row(row)
+                        row_count += 1
+
+    print(f"Wrote {row_count} rows to {output_path}.")
     print("Done.")
 
 if __name__ == "__main__":